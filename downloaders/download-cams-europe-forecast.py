@@ -5,17 +5,50 @@ single zip file for each year.
 
 import calendar
 import cdsapi
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
 import glob
+import os
 from os import remove
 from os.path import isfile
+import requests
+from requests.adapters import HTTPAdapter
 from secrets import CAMS_KEY
 import time as t
 import urllib3
+from urllib3.util.retry import Retry
 urllib3.disable_warnings()
 
-def main():
+# How many requests can wait in the ADS queue at the same time
+MAX_WORKERS = int(os.environ.get("CAMS_MAX_WORKERS", 4))
+
+
+def make_session():
+    '''
+    Creates an HTTP session that keeps its connection to the
+    ADS open between calls and retries the connections that
+    fail to open, instead of starting a download over.
+    '''
+
+    # Error responses from the ADS (busy queue, outages) are handed back
+    # to cdsapi, which already waits them out for much longer than this
+    retries = Retry(connect=5, read=0, status=0, backoff_factor=2, raise_on_status=False)
+
+    # Each session is only used by one thread, so one connection is enough
+    session = requests.Session()
+    session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=1, max_retries=retries))
+
+    return session
+
+
+def retrieve(task):
+    '''
+    Downloads a single request. Each call starts its own
+    API session, since they can't be shared between threads.
+    '''
+
+    dataset, request, outpath = task
 
     credentials = {
 
@@ -24,7 +57,13 @@ def main():
 
     }
 
-    c = cdsapi.Client(url=credentials['url'], key=credentials['key'])
+    c = cdsapi.Client(url=credentials['url'], key=credentials['key'], session=make_session())
+    c.retrieve(dataset, request, outpath)
+
+
+def main():
+
+    tasks = []
 
     for year in ['2023', '2022']:
 
@@ -51,7 +90,7 @@ def main():
             if len(files) > 0:
                 remove(files[0])
 
-        c.retrieve(
+        tasks.append((
             'cams-europe-air-quality-forecasts',
             {
                 'model': 'ensemble',
@@ -72,9 +111,14 @@ def main():
                 ],
                 'leadtime_hour': '0',
             },
-            outpath)
+            outpath))
 
+    # Most of the time is spent waiting in the ADS queue, so the
+    # requests can wait in parallel. Consuming the results raises
+    # any error from the downloads.
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        list(executor.map(retrieve, tasks))
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
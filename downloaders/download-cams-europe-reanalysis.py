@@ -4,16 +4,48 @@ for the interval 2018 – 2022. It downloads one zip file for each month in the
 
 import calendar
 import cdsapi
-from datetime import date
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from dateutil.relativedelta import relativedelta
+import os
 from os.path import isfile
+import requests
+from requests.adapters import HTTPAdapter
 from secrets import CAMS_KEY
 import time as t
 import urllib3
+from urllib3.util.retry import Retry
 urllib3.disable_warnings()
 
-def main():
+# How many requests can wait in the ADS queue at the same time
+MAX_WORKERS = int(os.environ.get("CAMS_MAX_WORKERS", 4))
+
+
+def make_session():
+    '''
+    Creates an HTTP session that keeps its connection to the
+    ADS open between calls and retries the connections that
+    fail to open, instead of starting a download over.
+    '''
+
+    # Error responses from the ADS (busy queue, outages) are handed back
+    # to cdsapi, which already waits them out for much longer than this
+    retries = Retry(connect=5, read=0, status=0, backoff_factor=2, raise_on_status=False)
+
+    # Each session is only used by one thread, so one connection is enough
+    session = requests.Session()
+    session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=1, max_retries=retries))
+
+    return session
+
 
+def retrieve(task):
+    '''
+    Downloads a single request. Each call starts its own
+    API session, since they can't be shared between threads.
+    '''
+
+    dataset, request, outpath = task
 
     # Credentials for acessing the ADS api
     credentials = {
@@ -23,8 +55,13 @@ def main():
 
     }
 
-    # Starting one API session
-    c = cdsapi.Client(url=credentials['url'], key=credentials['key'])
+    c = cdsapi.Client(url=credentials['url'], key=credentials['key'], session=make_session())
+    c.retrieve(dataset, request, outpath)
+
+
+def main():
+
+    tasks = []
 
     # For each year, downloads data for every month
     for year in [ 2018, 2019, 2020, 2021, 2022 ]:
@@ -36,11 +73,11 @@ def main():
             outpath = f'../data/CAMS-europe-reanalysis/raw/reanalysis/{year}-{month_str}.zip'
 
             # If there is already a file with this name (that is, the file was alraedy downloaded, skip this.)
-            if isfile(outpath) and f"{year}-{month}" != datetime.today().strftime("%Y-%m"):
+            if isfile(outpath) and f"{year}-{month_str}" != datetime.today().strftime("%Y-%m"):
                 continue
 
             # Save to a unique file per month
-            c.retrieve(
+            tasks.append((
                 'cams-europe-air-quality-reanalyses',
                 {
                     'variable': 'particulate_matter_2.5um',
@@ -55,8 +92,14 @@ def main():
                     'month': month_str,
                     'format': 'zip',
                 },
-                outpath) 
+                outpath))
+
+    # Most of the time is spent waiting in the ADS queue, so the
+    # requests can wait in parallel. Consuming the results raises
+    # any error from the downloads.
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        list(executor.map(retrieve, tasks))
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
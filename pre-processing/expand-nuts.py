@@ -7,6 +7,9 @@ in the regular NUTS 2021 geojson.
 import geopandas as gpd
 import pandas as pd
 
+# pyogrio reads and writes whole columns at once instead of feature by feature
+gpd.options.io_engine = "pyogrio"
+
 def standardize_columns(geometries, assigned_level):
         
     geometries['NUTS_ID'] = geometries['id']
@@ -15,7 +18,7 @@ def standardize_columns(geometries, assigned_level):
     geometries['NAME_LATN'] = geometries['name']
     geometries['NUTS_NAME'] = geometries['name']
     
-    geometries = geometries.drop(columns=["name"])
+    geometries.drop(columns=["name"], inplace=True)
     
     return geometries
 
@@ -51,10 +54,8 @@ def main():
     level_3 = [ukr_3, kos_3, bos_3, mol_3]
     
     ### Now we will standardize column names
-    for geometries in level_0:
-        geometries = standardize_columns(geometries, 0)
-    for geometries in level_3:
-        geometries = standardize_columns(geometries, 3)  
+    level_0 = [standardize_columns(geometries, 0) for geometries in level_0]
+    level_3 = [standardize_columns(geometries, 3) for geometries in level_3]
         
    
     ### We will also remove the other levels from the general nuts file
@@ -65,5 +66,8 @@ def main():
     
     nuts.to_file("../output/NUTS/expanded-NUTS.json", driver='GeoJSON')
 
+    ### The processing scripts read this columnar copy, which loads much faster
+    nuts.to_parquet("../output/NUTS/expanded-NUTS.parquet")
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
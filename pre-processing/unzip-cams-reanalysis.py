@@ -3,9 +3,29 @@ This script simply unzips the reanalysis iles downloaded from the CAMS ADS.
 Adapted from https://github.com/InfoAmazonia/engolindo-fumaca/blob/master/code/2_unzip_organize_cams_dataset.py
 '''
 
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import zipfile
 import glob
 import os
+import shutil
+
+def unzip_one(zip_file, td):
+    '''
+    Extracts the netCDF inside a single zip file,
+    naming it after the zip file.
+    '''
+
+    with zipfile.ZipFile(zip_file) as zipdata:
+
+        for zipinfo in zipdata.infolist():
+
+            zipinfo.filename = os.path.basename(zip_file).replace('.zip', '.nc')
+
+            # Copies the decompressed file in 1 MiB pieces
+            with zipdata.open(zipinfo) as src, open(os.path.join(td, zipinfo.filename), 'wb') as dst:
+                shutil.copyfileobj(src, dst, 1 << 20)
+
 
 def main():
 
@@ -14,16 +34,13 @@ def main():
 
     zip_files = glob.glob(f'{wd}*.zip')
 
-    for zip_file in zip_files:
-
-        zipdata = zipfile.ZipFile(zip_file)
-        zipinfos = zipdata.infolist()
+    os.makedirs(td, exist_ok=True)
 
-        for zipinfo in zipinfos:
-
-            zipinfo.filename = os.path.basename(zip_file).replace('.zip', '.nc')
-            zipdata.extract(zipinfo, td)
+    # Each file is decompressed on its own core. Consuming the
+    # results raises any error from the workers.
+    with ProcessPoolExecutor() as pool:
+        list(pool.map(partial(unzip_one, td=td), zip_files))
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
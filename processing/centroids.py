@@ -1,48 +1,109 @@
+import numpy as np
 import xarray as xr
 import geopandas as gpd
 import pandas as pd
 from shapely.geometry import Point
 
+def nearest_index(coords, values):
+    """
+    Finds the position of the grid cell closest to each value,
+    using the grid origin and spacing instead of a search.
+    Returns None if the coordinates are not evenly spaced,
+    or if there are too few of them to tell the spacing.
+    """
+
+    if len(coords) < 2:
+        return None
+
+    step = coords[1] - coords[0]
+    if not np.allclose(np.diff(coords), step):
+        return None
+
+    index = np.rint((values - coords[0]) / step).astype(np.int64)
+
+    # Points outside of the grid get the closest edge cell, like sel(method='nearest')
+    return np.clip(index, 0, len(coords) - 1)
+
+
 def sample_raster_values(raster, points):   
     """
     Extracts time series from raster for given points.
-    Returns a concatenated DataFrame.
+    Returns a (point, time) array, loaded into memory.
     """
-    
-    results = []
 
-    for index, row in points.iterrows():
+    cols = nearest_index(raster.x.values, points.longitude.values)
+    rows = nearest_index(raster.y.values, points.latitude.values)
 
-        x, y = row.longitude, row.latitude
+    # Extract the time series for all points at once – if there's no time
+    # dimension this should also work. Indexers that share a 'point' dimension
+    # select one pixel per point, instead of every combination of x and y.
+    if cols is not None and rows is not None:
+        time_series_at_points = raster.isel(x=xr.DataArray(cols, dims='point'),
+                                            y=xr.DataArray(rows, dims='point'))
 
-        # Extract the time series for the given point – if there's no time dimension
-        # this should also work, albeit not very efficiently
-        time_series_at_point = raster.sel(x=x, y=y, method='nearest')
-        
-        # Convert to DataFrame, add id data
-        df_at_point = time_series_at_point.to_dataframe().reset_index()
-        df_at_point['lau_id'] = row.lau_id
-        df_at_point['lau_name'] = row.lau_name
-        df_at_point['country'] = row.country
-        df_at_point['x'] = round(row.longitude, 4)
-        df_at_point['y'] = round(row.latitude, 4)
+    # Irregular or single-cell grids still need a search
+    else:
+        xs = xr.DataArray(points.longitude.values, dims='point')
+        ys = xr.DataArray(points.latitude.values, dims='point')
+        time_series_at_points = raster.sel(x=xs, y=ys, method='nearest')
 
-        
-        # append to results
-        results.append(df_at_point)
+    # Number the points by their position and read them. For dask-backed
+    # rasters, only the chunks that hold the points are loaded.
+    time_series_at_points = time_series_at_points.assign_coords(point=np.arange(len(points)))
 
-    # Concatenate
-    results = pd.concat(results)
-    return results
+    return time_series_at_points.compute()
 
 
-def simplify_csv(df):
+def save_samples(samples, points, outpath, batch_size=50):
     """
-    Drops specified columns from DataFrame.
-    Returns updated DataFrame.
+    Writes the time series sampled for each point to a CSV
+    file, together with the point data, a batch of points at a time.
     """
-    df = df.drop(columns=[col for col in ['level', 'spatial_ref'] if col in df.columns])
-    return df
+
+    # Id data
+    ids = points[['lau_id', 'lau_name', 'country']].reset_index(drop=True)
+    ids['x'] = np.round(points.longitude.to_numpy(), 4)
+    ids['y'] = np.round(points.latitude.to_numpy(), 4)
+
+    with open(outpath, 'w', newline='') as f:
+
+        for start in range(0, len(ids), batch_size):
+
+            batch = samples.isel(point=slice(start, start + batch_size))
+
+            # Convert to DataFrame, keeping the rows of each point together
+            dim_order = ['point'] + [dim for dim in batch.dims if dim != 'point']
+            results = batch.to_dataframe(dim_order=dim_order).reset_index()
+
+            # The x and y columns should have the point coordinates, not the pixel centers
+            results = results.drop(columns=['x', 'y'])
+
+            # Add id data. Points are numbered by their position in the id
+            # data, so the values can be taken directly instead of merged.
+            point = results.pop('point').to_numpy()
+            for column in ids.columns:
+                results[column] = ids[column].to_numpy()[point]
+
+            # Only the first batch writes the header
+            results.to_csv(f, header=(start == 0), index=False)
+
+
+def open_raster(path):
+    """
+    Opens the pollution variable of a zarr store as a dask
+    array, using the same chunks it is stored with on disk.
+    """
+
+    ds = xr.open_zarr(path, consolidated=True, decode_coords='all')
+
+    # Keeps only the pollution values, without coordinates
+    # such as spatial_ref and level that don't go in the CSV
+    var = [v for v in ds.data_vars if 'pm2p5' in v][0]
+    raster = ds[var].reset_coords(drop=True)
+    if 'level' in raster.dims:
+        raster = raster.squeeze('level', drop=True)
+
+    return raster
 
 
 def main():
@@ -51,28 +112,27 @@ def main():
     """
 
     # Reads raster data
-    reanalysis = xr.open_dataset("../output/5.europe-reanalysis-reprojected.netcdf", decode_coords='all')
-    forecast = xr.open_dataset("../output/5.europe-forecast-reprojected.netcdf", decode_coords='all')
+    reanalysis = open_raster("../output/5.europe-reanalysis-reprojected.zarr")
+    forecast = open_raster("../output/5.europe-forecast-reprojected.zarr")
 
     # Reads points
     points = pd.read_csv("../data/LAU_Centers/lau_2020_nuts_2021_pop_2018_p_2_adjusted_intersection.csv")
-    points = points.groupby("country").apply(lambda x: x.nlargest(15, 'population')) # n largest cities of each country
+    # n largest cities of each country – a single sort keeps the countries in
+    # alphabetical order and the cities from the largest to the smallest
+    points = points.sort_values(['country', 'population'], ascending=[True, False], kind='mergesort')
+    points = points.groupby("country", sort=False).head(15)
     points = points.reset_index(drop=True)
     
     # 2022-2023 forecast daily values
-    result = sample_raster_values(forecast, points)
-    result = simplify_csv(result)
-    result.to_csv("../output/csvs/centroids-forecast-1D.csv", index=False)
+    samples = sample_raster_values(forecast, points)
+    save_samples(samples, points, "../output/csvs/centroids-forecast-1D.csv")
     
     # 2018-2022 daily values
-    result = sample_raster_values(reanalysis, points)
-    result = simplify_csv(result)
-    result.to_csv("../output/csvs/centroids-reanalysis-1D.csv", index=False)
-
-    # 2018-2022 yearly averages
-    result = sample_raster_values(reanalysis.resample(time='Y').mean(), points)
-    result = simplify_csv(result)
-    result.to_csv("../output/csvs/centroids-reanalysis-Y.csv", index=False)
+    samples = sample_raster_values(reanalysis, points)
+    save_samples(samples, points, "../output/csvs/centroids-reanalysis-1D.csv")
+
+    # 2018-2022 yearly averages – the daily samples already have everything we need
+    save_samples(samples.resample(time='Y').mean(), points, "../output/csvs/centroids-reanalysis-Y.csv")
 
     
 if __name__ == "__main__":
@@ -0,0 +1,113 @@
+'''
+This file has the helpers shared by the processing scripts,
+which can't import each other because of their file names.
+'''
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import xarray as xr
+
+
+def get_labels(thresholds=[0, 5, 10, 15, 20, 25]):
+    '''
+    Creates a label for each range of values between the thresholds,
+    such as "0-5", plus one for the values above the last one ("25+").
+    '''
+
+    labels = [f"{thresholds[i]}-{thresholds[i+1]}" for i in range(len(thresholds) - 1)]
+    labels.append(f"{thresholds[-1]}+")
+
+    return labels
+
+
+def digitize(values, thresholds):
+    '''
+    Same as np.digitize, but missing values go to bin 0
+    with the values below the first threshold.
+    '''
+
+    bin_idx = np.digitize(values, thresholds).astype(np.int8)
+    bin_idx[np.isnan(values)] = 0
+
+    return bin_idx
+
+
+def get_bins(pm2p5, thresholds=[0, 5, 10, 15, 20, 25]):
+    '''
+    Assigns each value of an input dataarray to a range of values, defined by the thresholds.
+    
+    Bin 1 covers the range from thresholds[0] to thresholds[1], bin 2 the range from
+    thresholds[1] to thresholds[2], and so on. The last bin covers the range from the last
+    threshold to infinity. Values below the first threshold, or missing, are in bin 0.
+    All the ranges are stored in a single int8 array, instead of one mask for each range.
+    
+    Parameters
+    ----------
+    pm2p5 : xarray.Dataset
+        The input dataset from which the bins are to be computed.
+        It should have the pm2.5 concentration data as 'pm2p5_mean'.
+    thresholds : list, optional
+        The list of thresholds defining the ranges.
+        Default is [0, 5, 10, 15, 20, 25].
+    
+    Returns
+    -------
+    bin_idx : xarray.DataArray
+        An int8 dataarray with the bin of each value.
+    labels : list of str
+        The list of labels for bins 1 and up. Each label represents
+        the range of values that the corresponding bin covers.
+    
+    Example
+    -------
+    bin_idx, labels = get_bins(pm2p5)
+    for i, label in enumerate(labels, start=1):
+        print(f"For range {label}, there are {(bin_idx == i).sum()} cells.")
+    '''
+
+    bin_idx = xr.apply_ufunc(digitize, 
+                             pm2p5.pm2p5_mean, 
+                             kwargs={'thresholds': np.asarray(thresholds)},
+                             dask='parallelized',
+                             output_dtypes=[np.int8])
+
+    return bin_idx, get_labels(thresholds)
+
+
+def cut(values, bins, labels):
+    """
+    Does the same as pd.cut(values, bins=bins, labels=labels, include_lowest=True),
+    but finds all the bins with a single np.searchsorted call.
+    """
+
+    values = np.asarray(values, dtype='float64')
+
+    # Bins are closed on the right, so a value that is equal
+    # to an edge belongs to the bin that ends there
+    codes = np.searchsorted(bins, values, side='left') - 1
+
+    # The lowest edge is included in the first bin
+    codes[values == bins[0]] = 0
+
+    # Values out of the bins, or missing, get no category
+    codes[(values < bins[0]) | (values > bins[-1]) | np.isnan(values)] = -1
+
+    return pd.Categorical.from_codes(codes, categories=labels, ordered=True)
+
+
+def save_csv(df, outpath):
+    '''
+    Writes the dataframe to a CSV file with pyarrow's C++ writer,
+    which is much faster than df.to_csv on these tables. The time
+    steps are written as plain dates, like pandas does.
+    '''
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+
+    for i, field in enumerate(table.schema):
+        if pa.types.is_timestamp(field.type):
+            table = table.set_column(i, field.name, table.column(i).cast(pa.date32()))
+
+    pacsv.write_csv(table, outpath)
@@ -0,0 +1,58 @@
+'''
+This file has the numba-compiled loops used by
+the processing scripts for their heaviest steps.
+'''
+
+import numba
+from numba import njit, prange
+import numpy as np
+
+# Starts numba's thread pool from the main thread. Starting it lazily
+# from several dask threads at once can deadlock.
+numba.get_num_threads()
+
+
+@njit(parallel=True)
+def accumulate_affected(population, region, bin_idx, n_regions, n_bins):
+    '''
+    Sums the population of each region for each range of pollution
+    levels, in a single pass over the pixels of one time step.
+
+    Parameters
+    ----------
+    population : numpy.ndarray
+        1-D array with the population of each pixel. Must not have NaNs.
+    region : numpy.ndarray
+        1-D integer array with the position of the region each pixel
+        belongs to, or -1 for pixels outside of all regions.
+    bin_idx : numpy.ndarray
+        1-D integer array with the range of pollution levels each pixel
+        falls in, from 0 to n_bins - 1.
+    n_regions : int
+        The number of regions.
+    n_bins : int
+        The number of ranges of pollution levels.
+
+    Returns
+    -------
+    numpy.ndarray
+        A (n_regions, n_bins) array with the population of each region and range.
+    '''
+
+    # Each thread sums its share of the pixels into its own buffer,
+    # so they never write to the same place
+    n_chunks = numba.get_num_threads()
+    chunk_size = (population.size + n_chunks - 1) // n_chunks
+    partial = np.zeros((n_chunks, n_regions, n_bins))
+
+    for c in prange(n_chunks):
+
+        for i in range(c * chunk_size, min((c + 1) * chunk_size, population.size)):
+
+            r = region[i]
+            if r < 0:
+                continue
+
+            partial[c, r, bin_idx[i]] += population[i]
+
+    return partial.sum(axis=0)
@@ -3,7 +3,61 @@ In this notebook, we will concatenate all the disparate CSV
 files into useful, meaningful Excel files.
 '''
 
+from helpers import cut
 import pandas as pd
+import xlsxwriter
+
+# Types for the columns shared by all the CSV files made by the processing
+# scripts. Dates are kept as text, like in the original files.
+CSV_DTYPES = {
+    "time": "string",
+    "NUTS_ID": "string",
+    "CNTR_CODE": "category",
+    "NAME_LATN": "string",
+    "pm2p5_mean": "float32",
+}
+
+# Thresholds of the EU and WHO air quality categories
+EU_BINS = [0, 10, 20, 25, 50, 75, 800]
+EU_LABELS = ['Good (0-10)', 
+             'Fair (10-20)', 
+             'Moderate (20-25)', 
+             'Poor (25-50)', 
+             'Very poor (50-75)', 
+             'Extremely poor (75-800)']
+
+WHO_BINS = [0, 15, 25, 37.5, 50, 75, 800]
+WHO_LABELS = ["AQG level (0-15)", "Interim target 4 (15-25)" , 
+              "Interim target 3 (25-37.5)", "Interim target 2 (37.5-50)", 
+              "Interim target 1 (50-75)", "Over interim targets (75+)"]
+
+def write_excel(df, outpath):
+    """
+    Writes the DataFrame to an Excel file laid out like df.to_excel(outpath),
+    using xlsxwriter's constant memory mode, which sends each row to disk
+    as soon as the next one starts. pandas fills the sheet column by column,
+    so it can't be used in that mode.
+    """
+
+    workbook = xlsxwriter.Workbook(outpath, {'constant_memory': True})
+    worksheet = workbook.add_worksheet()
+
+    # Same look as the pandas header and index cells
+    header = workbook.add_format({'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'})
+
+    worksheet.write_row(0, 1, list(df.columns), header)
+
+    for row, (index, *values) in enumerate(df.itertuples(name=None), start=1):
+
+        worksheet.write(row, 0, index, header)
+
+        # Missing values are left as empty cells
+        for col, value in enumerate(values, start=1):
+            if not pd.isna(value):
+                worksheet.write(row, col, value)
+
+    workbook.close()
+
 
 def bin_pollution(df):  
     """
@@ -37,24 +91,11 @@ def bin_pollution(df):
         
     """
     
-    # Define the thresholds
-    bins = [0, 10, 20, 25, 50, 75, 800]
-    labels = ['Good (0-10)', 
-              'Fair (10-20)', 
-              'Moderate (20-25)', 
-              'Poor (25-50)', 
-              'Very poor (50-75)', 
-              'Extremely poor (75-800)']
-
-    # Use pd.cut() to categorize values
-    df['EU_category'] = pd.cut(df['pm2p5_mean'], bins=bins, labels=labels, include_lowest=True)
+    # Categorize values
+    df['EU_category'] = cut(df['pm2p5_mean'], bins=EU_BINS, labels=EU_LABELS)
 
     # Repeats for WHO levels
-    bins = [0, 15, 25, 37.5, 50, 75, 800]
-    labels = ["AQG level (0-15)", "Interim target 4 (15-25)" , 
-              "Interim target 3 (25-37.5)", "Interim target 2 (37.5-50)", 
-              "Interim target 1 (50-75)", "Over interim targets (75+)"]
-    df['WHO_category'] = pd.cut(df['pm2p5_mean'], bins=bins, labels=labels, include_lowest=True)
+    df['WHO_category'] = cut(df['pm2p5_mean'], bins=WHO_BINS, labels=WHO_LABELS)
     
     return df
 
@@ -63,85 +104,46 @@ def bin_pollution(df):
 ###################################
 ### Yearly population estimates ###
 ###################################
-def nuts0_yearly_patterns(inpath, outpath):
-
-    df = pd.read_csv(inpath)
-
-    # Removes columns we don't need
-    df = df.drop(columns='region_code')
-    
-    df['time'] = pd.to_datetime(df.time)
-    df['time'] = df.time.dt.year
-    
-    columns = {
-        "time": "Year",
-        "NUTS_ID": "NUTS ID",
-        "CNTR_CODE": "Country code",
-        "NAME_LATN": "Name (latin characters)",
-        "pm2p5_mean": "Yearly PM 2.5 average (µg/m³)",
-        "total_population": "Population estimate (GHSL 2020)",
-        "affected_population_0-5": "0–5µg/m³ - population",
-        "affected_population_5-10": "5–10µg/m³ - population",
-        "affected_population_10-15": "10–15µg/m³ - population",
-        "affected_population_15-20": "15–20µg/m³ - population",
-        "affected_population_20-25": "20–25µg/m³ - population",
-        "affected_population_25+": "25+ µg/m³ - population",
-        "percentage_0-5": "0–5µg/m³ - percentage",
-        "percentage_5-10": "5–10µg/m³ - percentage",
-        "percentage_10-15": "10–15µg/m³ - percentage",
-        "percentage_15-20": "15–20µg/m³ - percentage",
-        "percentage_20-25": "20–25µg/m³ - percentage",
-        "percentage_25+": "25+ µg/m³ - percentage",
-    }
-
-    # Renames columns for better reading
-    df = df.rename(columns=columns)
-    
-    df = df[columns.values()]
-    
-    df.to_excel(outpath)
-
 
-########################################
-### NUTS3 level population estimates ###
-########################################
-def nuts3_yearly_patterns(inpath, outpath):
+# Columns kept in the yearly files, with their
+# names renamed for better reading
+YEARLY_COLUMNS = {
+    "time": "Year",
+    "NUTS_ID": "NUTS ID",
+    "CNTR_CODE": "Country code",
+    "NAME_LATN": "Name (latin characters)",
+    "pm2p5_mean": "Yearly PM 2.5 average (µg/m³)",
+    "total_population": "Population estimate (GHSL 2020)",
+    "affected_population_0-5": "0–5µg/m³ - population",
+    "affected_population_5-10": "5–10µg/m³ - population",
+    "affected_population_10-15": "10–15µg/m³ - population",
+    "affected_population_15-20": "15–20µg/m³ - population",
+    "affected_population_20-25": "20–25µg/m³ - population",
+    "affected_population_25+": "25+ µg/m³ - population",
+    "percentage_0-5": "0–5µg/m³ - percentage",
+    "percentage_5-10": "5–10µg/m³ - percentage",
+    "percentage_10-15": "10–15µg/m³ - percentage",
+    "percentage_15-20": "15–20µg/m³ - percentage",
+    "percentage_20-25": "20–25µg/m³ - percentage",
+    "percentage_25+": "25+ µg/m³ - percentage",
+}
+
+def yearly_patterns(inpath, outpath, columns=YEARLY_COLUMNS):
+    """
+    Makes the Excel file with yearly pollution averages and population
+    estimates for any NUTS level, keeping and renaming the given columns.
+    """
 
-    df = pd.read_csv(inpath)
+    df = pd.read_csv(inpath, engine='pyarrow', dtype=CSV_DTYPES)
 
-    # Removes columns we don't need
-    df = df.drop(columns='region_code')
-    
     df['time'] = pd.to_datetime(df.time)
     df['time'] = df.time.dt.year
-    
-    columns = {
-        "time": "Year",
-        "NUTS_ID": "NUTS ID",
-        "CNTR_CODE": "Country code",
-        "NAME_LATN": "Name (latin characters)",
-        "pm2p5_mean": "Yearly PM 2.5 average (µg/m³)",
-        "total_population": "Population estimate (GHSL 2020)",
-        "affected_population_0-5": "0–5µg/m³ - population",
-        "affected_population_5-10": "5–10µg/m³ - population",
-        "affected_population_10-15": "10–15µg/m³ - population",
-        "affected_population_15-20": "15–20µg/m³ - population",
-        "affected_population_20-25": "20–25µg/m³ - population",
-        "affected_population_25+": "25+ µg/m³ - population",
-        "percentage_0-5": "0–5µg/m³ - percentage",
-        "percentage_5-10": "5–10µg/m³ - percentage",
-        "percentage_10-15": "10–15µg/m³ - percentage",
-        "percentage_15-20": "15–20µg/m³ - percentage",
-        "percentage_20-25": "20–25µg/m³ - percentage",
-        "percentage_25+": "25+ µg/m³ - percentage",
-    }
 
-    # Renames columns for better reading
-    df = df.rename(columns=columns)
-    
-    df = df[columns.values()]
+    # Keeps only the columns we need, in order, and renames them for better reading
+    df = df.loc[:, list(columns)].set_axis(list(columns.values()), axis=1)
     
-    df.to_excel(outpath)
+    write_excel(df, outpath)
+
 
 ######################
 ### Daily datasets ###
@@ -149,10 +151,15 @@ def nuts3_yearly_patterns(inpath, outpath):
 def nuts3_dw_patterns(inpath, outpath):
 
 
-    df = pd.read_csv(inpath)
+    df = pd.read_csv(inpath, engine='pyarrow', dtype=CSV_DTYPES)
     
     if 'EU_category' not in df.columns:
         df = bin_pollution(df)
+
+    # Categories read from the CSV are plain text. Making them categorical
+    # again keeps them dictionary-encoded in the Parquet file.
+    else:
+        df['EU_category'] = df['EU_category'].astype(pd.CategoricalDtype(EU_LABELS, ordered=True))
         
     
     columns = {
@@ -164,23 +171,29 @@ def nuts3_dw_patterns(inpath, outpath):
         "EU_category": "EU Air Quality Guidelines classification"
     }
     
+    # Single precision is plenty for the averages and halves their size
+    df['pm2p5_mean'] = df['pm2p5_mean'].astype('float32')
+
     df = df.rename(columns=columns)
     
     df = df[columns.values()]
     
-    if df.shape[0] < 2739000:
-        df.to_excel(outpath)
-    else:
-        df.to_csv(outpath)
+    # Parquet keeps the column types, including the categories, and
+    # is much faster to write than Excel, so it's always saved
+    df.to_parquet(outpath.replace('.xlsx', '.parquet'), compression='snappy')
+
+    # Excel files are only made for tables that are small enough to handle in a spreadsheet
+    if df.shape[0] < 100_000:
+        write_excel(df, outpath)
     
   
 
 def main():
 
-    # nuts0_yearly_patterns("../output/csvs/reanalysis-NUTS0-Y.csv", "../output/excel/CAMS-Europe-Renalaysis-Countries-Yearly-2018-2022.xlsx")
-    nuts3_yearly_patterns("../output/csvs/reanalysis-NUTS1-Y.csv", "../output/excel/CAMS-Europe-Renalysis-NUTS1-Yearly-2018-2022.xlsx")
-    # nuts0_yearly_patterns("../output/csvs/forecast-classified-NUTS0-Y-2022.csv", "../output/excel/CAMS-Europe-Forecast-Countries-Yearly-2022.xlsx")
-    # nuts3_yearly_patterns("../output/csvs/reanalysis-NUTS3-Y.csv", "../output/excel/NUTS3-population-estimates-2018-2022-CAMS-reanalysis.xlsx")
+    # yearly_patterns("../output/csvs/reanalysis-NUTS0-Y.csv", "../output/excel/CAMS-Europe-Renalaysis-Countries-Yearly-2018-2022.xlsx")
+    yearly_patterns("../output/csvs/reanalysis-NUTS1-Y.csv", "../output/excel/CAMS-Europe-Renalysis-NUTS1-Yearly-2018-2022.xlsx")
+    # yearly_patterns("../output/csvs/forecast-classified-NUTS0-Y-2022.csv", "../output/excel/CAMS-Europe-Forecast-Countries-Yearly-2022.xlsx")
+    # yearly_patterns("../output/csvs/reanalysis-NUTS3-Y.csv", "../output/excel/NUTS3-population-estimates-2018-2022-CAMS-reanalysis.xlsx")
 
     # nuts3_dw_patterns("../output/csvs/forecast-classified-NUTS3-1D-2023.csv", "../output/excel/CAMS-Europe-Forecast-Daily-2023.xlsx")
     # nuts3_dw_patterns("../output/csvs/forecast-classified-NUTS3-1D-2022.csv", "../output/excel/CAMS-Europe-Forecast-Daily-2022.xlsx")
@@ -3,15 +3,20 @@ This script is used to process the slightly different
 data format used in the CAMS Forecast data.
 '''
 
-from functools import reduce
+import dask
+from dask.distributed import Client
 from geocube.api.core import make_geocube
 import geopandas as gpd
-import matplotlib.pyplot as plt
-import matplotlib.colors as mcolors
+import hashlib
+from helpers import cut, get_bins, save_csv
+from kernels import accumulate_affected
 import numpy as np
+import os
 import pandas as pd
 from rasterio.enums import Resampling
+from reduce import save_zarr
 import rioxarray
+import threading
 import xarray as xr
 import warnings
 
@@ -20,6 +25,13 @@ from contextlib import contextmanager
 
 pd.options.mode.chained_assignment = None  # default='warn'
 warnings.simplefilter(action='ignore', category=FutureWarning)
+# xarray hands the groupby and resample reductions to flox, which must be installed
+xr.set_options(use_flox=True)
+
+NUTS_PATH = "../output/NUTS/expanded-NUTS.parquet"
+
+# Each warp already runs on all the cores, so the runs take turns instead of warping at once
+WARP_LOCK = threading.Lock()
 
 @contextmanager
 def timer(description: str = 'Time elapsed'):
@@ -57,16 +69,45 @@ def rescale(raster, factor, algorithm):
     new_width = int(raster.rio.width * factor)
     new_height = int(raster.rio.height * factor)
 
-    raster = raster.rio.reproject(
-        raster.rio.crs,
-        shape=(new_height, new_width),
-        resampling=algorithm,
-    )
+    # Warps on all the cores, with a 512 MB working buffer (warp_mem_limit is in MB)
+    with WARP_LOCK:
+        raster = raster.rio.reproject(
+            raster.rio.crs,
+            shape=(new_height, new_width),
+            resampling=algorithm,
+            num_threads=os.cpu_count(),
+            warp_mem_limit=512,
+        )
 
 
     return raster
 
 
+def get_cache_path(name, key):
+    '''
+    Builds the path of a cache store from a hash of everything
+    its content depends on, so it's rebuilt when any of it changes.
+    '''
+
+    key_hash = hashlib.md5(repr(key).encode()).hexdigest()[:12]
+
+    return f"../output/cache/{name}-{key_hash}.zarr"
+
+
+def save_cache(ds, path, chunks):
+    '''
+    Saves an intermediate dataset to a zarr store, so the following
+    runs can skip the steps that produced it, and reopens it lazily
+    from there. save_zarr only moves the store to its path once it's
+    complete, so a run that is cut off leaves no cache behind.
+    '''
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    save_zarr(ds, path, chunks)
+
+    return xr.open_zarr(path, decode_coords='all')
+
+
 def get_zones(raster, vector, varname, keyname='region_code'):
     """
     Attributes each grid cell of a raster to a unique ID based on intersection with vector polygons. The function 
@@ -104,11 +145,13 @@ def get_zones(raster, vector, varname, keyname='region_code'):
     # Keeps only the variable of interest
     raster = raster[varname]
             
-    # Creates a key to mark the grid cells with
-    vector[keyname] = range(0, vector.shape[0]) # in geocube, the ids need to be numbers :/
+    # Creates a key to mark the grid cells with, using the codes of the
+    # NUTS IDs as a categorical – in geocube, the ids need to be numbers :/
+    cat = pd.Categorical(vector['NUTS_ID'])
+    vector[keyname] = cat.codes.astype(np.int32)
       
     # A correspondence dict for easier access
-    corresp = {row["NUTS_ID"]: row[keyname] for index, row in vector[[keyname, 'NUTS_ID']].iterrows()}
+    corresp = dict(zip(cat.categories, range(len(cat.categories))))
     
     
     # Creates an output grid – that is, an xarray representation of the vector data
@@ -117,72 +160,13 @@ def get_zones(raster, vector, varname, keyname='region_code'):
         vector_data=vector, # The shapes that we will use as a mold
         measurements=[keyname], # This is the LABEL we will stamp the pixels with
         like=raster, # The new cube will have the shape of the raster
+        fill=-1, # Pixels outside of all polygons
     )
-    
-    return outgrid, corresp
-
-
-def get_masks(pm2p5, thresholds=[0, 5, 10, 15, 20, 25]):
-    '''
-    Generates a list of masks and corresponding labels for an input dataarray.
-    
-    Each mask corresponds to a range of values defined by the thresholds. For instance,
-    the first mask will cover the range from thresholds[0] to thresholds[1], the second
-    mask will cover the range from thresholds[1] to thresholds[2], and so on. The masks
-    can be used to filter the dataarray for values within specific ranges.
-    
-    The last mask will cover the range from the last threshold to infinity.
-    
-    Parameters
-    ----------
-    pm2p5 : xarray.DataArray
-        The input dataarray from which the masks are to be generated.
-        This array should represent the pm2.5 concentration data.
-    thresholds : list, optional
-        The list of thresholds defining the ranges for which masks are to be generated.
-        Default is [0, 5, 10, 15, 20, 25].
-    
-    Returns
-    -------
-    masks : list of xarray.DataArray
-        The list of generated masks. Each mask corresponds to a range of values.
-    labels : list of str
-        The list of labels corresponding to each mask. Each label represents the
-        range of values that the corresponding mask covers.
-    
-    Example
-    -------
-    masks, labels = get_masks(pm2p5)
-    for mask, label in zip(masks, labels):
-        print(f"For range {label}, there are {mask.sum()} cells.")
-    '''
-    
-    # Initialize an empty list for the masks
-    masks = []
-
-    # Initialize an empty list for the labels
-    labels = []
-
-    # Iterate over the thresholds
-    for i in range(len(thresholds) - 1):
-        # Create a mask for each range
-        mask = (pm2p5.pm2p5_mean >= thresholds[i]) & (pm2p5.pm2p5_mean < thresholds[i+1])
-
-        # Append the mask to the list
-        masks.append(mask)
 
-        # Create a label for each range
-        label = f"{thresholds[i]}-{thresholds[i+1]}"
-
-        # Append the label to the list
-        labels.append(label)
-
-    # Create a mask for the last threshold ("25+")
-    mask = (pm2p5.pm2p5_mean >= thresholds[-1])
-    masks.append(mask)
-    labels.append(f"{thresholds[-1]}+")
+    # The ids fit in int32, so there's no need to keep them as floats
+    outgrid[keyname] = outgrid[keyname].astype(np.int32)
     
-    return masks, labels
+    return outgrid, corresp
 
 
 def reproject_to_match(source, target):
@@ -203,8 +187,13 @@ def reproject_to_match(source, target):
     -----
     This docstring was created with the help of GPT-4, an AI language model developed by OpenAI.
     """
-    # Reprojects the source raster to match the target raster
-    rpjct = source.rio.reproject_match(target, resampling=Resampling.sum)
+    # Reprojects the source raster to match the target raster,
+    # on all the cores and with a 512 MB warp buffer (warp_mem_limit is in MB)
+    with WARP_LOCK:
+        rpjct = source.rio.reproject_match(target, 
+                                           resampling=Resampling.sum,
+                                           num_threads=os.cpu_count(),
+                                           warp_mem_limit=512)
 
     # Assigns the coordinates from the target raster to the reprojected source raster to avoid rounding errors
     rpjct = rpjct.assign_coords({
@@ -215,93 +204,113 @@ def reproject_to_match(source, target):
     return rpjct
 
 
-def compute_affected_population(ghsl, zones, masks, labels):
+def reduce_chunk(population, bin_idx, region, n_regions, n_bins):
+    '''
+    Sums the population of each region and range of pollution levels
+    over the last two (y, x) axes, for each of the leading axes.
+    '''
+
+    # Only the pixels inside a region count. They are picked once for
+    # the whole block, so each time step only reads their bins.
+    region = region.ravel()
+    keep = region >= 0
+
+    # A single population grid also lets empty pixels be skipped
+    if population.size == region.size:
+        keep &= population.ravel() > 0
+
+    pixels = np.flatnonzero(keep)
+    region = region[pixels]
+    population = np.nan_to_num(population.reshape(population.shape[:-2] + (-1,))[..., pixels])
+    bin_idx = bin_idx.reshape(bin_idx.shape[:-2] + (-1,))[..., pixels]
+
+    leading = np.broadcast_shapes(population.shape[:-1], bin_idx.shape[:-1])
+    population = np.broadcast_to(population, leading + population.shape[-1:])
+    bin_idx = np.broadcast_to(bin_idx, leading + bin_idx.shape[-1:])
+
+    out = np.empty(leading + (n_regions, n_bins))
+    for idx in np.ndindex(leading):
+        out[idx] = accumulate_affected(population[idx], 
+                                       region, 
+                                       bin_idx[idx], 
+                                       n_regions,
+                                       n_bins)
+
+    return out
+
+
+def compute_affected_population(ghsl, zones, bin_idx, labels):
     """
     Computes the total affected population in each region for various ranges of pollution.
     
-    This function uses a list of masks to filter the population data for specific ranges of 
-    pollution. For each mask, the function calculates the sum of the population in areas where 
-    the pollution level falls within the range that the mask represents. The function also 
-    computes the total population per region without applying any masks. The function outputs 
-    a dataframe where each column represents the total affected population for a specific range
-    of pollution levels, along with a column for the total population per region.
+    For each time step, a compiled kernel goes over the pixels once and adds the population
+    of each pixel to the range of pollution levels and the region it belongs to – instead 
+    of filtering and grouping the whole population grid once for each range. The total 
+    population per region is the sum of all ranges, including bin 0 with the pixels 
+    that fall in none of them. The function outputs a dataframe where each column represents
+    the total affected population for a specific range of pollution levels, along with a
+    column for the total population per region.
     
     Parameters
     ----------
-    ghsl : xarray.DataArray
-        A data array representing the global human settlement layer (GHSL) population grid.
+    ghsl : xarray.Dataset
+        A dataset with the global human settlement layer (GHSL) population grid as 'population'.
+        The grid can be 2-D, in which case it is used for every time step.
     zones : xarray.Dataset
         A dataset representing the different regions/zones.
-    masks : list of xarray.DataArray
-        A list of masks representing the different ranges of pollution. Each mask should 
-        correspond to a range of pollution levels.
+    bin_idx : xarray.DataArray
+        An integer dataarray with the range of pollution levels each pixel falls in,
+        as returned by get_bins.
     labels : list of str
-        A list of labels for each mask. Each label should represent the range of pollution 
-        levels that the corresponding mask covers.
+        A list of labels for bins 1 and up. Each label should represent the range 
+        of pollution levels that the corresponding bin covers.
     
     Returns
     -------
     merged : pandas.DataFrame
         A dataframe where each column represents the total affected population for a specific 
         range of pollution levels, along with a column for the total population per region.
-        The index of the dataframe represents the region codes.
+        Each row represents one region code and time step.
     """
 
-    # Re-assign the coordinates to match the zones
-    ghsl = ghsl.assign_coords({"x": zones["x"], "y": zones["y"]})
-    
-    # Attributes a zone to each population grid
-    ghsl['region_code'] = zones.region_code
-
-    # Calculate the total population per region without applying any masks
-    total_pop = ghsl.groupby("region_code").sum().population.to_dataframe().reset_index()
-    total_pop = total_pop.rename(columns={"population": "total_population"})
-
-    # Generate a list to store the dataframes
-    dfs = [total_pop]
-
-    # For each mask in the list
-    for mask, label in zip(masks, labels):
-        
-        print(f"Processing mask: {label}")
-        
-        # Assign coordinates to mask
-        mask = mask.assign_coords({"x": ghsl.x, "y": ghsl.y, "time": ghsl.time})
-        
-        # Applies the mask
-        masked_ghsl = ghsl.where(mask)
-        
-        # The region code always should persist, even if the 
-        # mask applies to it. The population values are the only ones
-        # that should be filtered.
-        masked_ghsl["region_code"] = ghsl.region_code
-        
-        print("attempting xarray groupby")
-        # Apply the mask to the data
-        affected_pop = (masked_ghsl
-                            .groupby("region_code")
-                            .sum()
-                            .population)
-        
-        #display(affected_pop)
-        print("attempting convertion to dataframe")
-        affected_pop = (affected_pop.to_dataframe()
-                                    .reset_index())
-        
-        #display(affected_pop)
-                
-        # Rename the column to reflect the range of values it represents
-        affected_pop = affected_pop.rename(columns={"population":f"affected_population_{label}"})
-        
-        print("appending")
-        # Append to the list of dataframes
-        dfs.append(affected_pop)
-
-    # Merge all dataframes
-    merged = reduce(lambda left,right: pd.merge(left,right, on=['region_code', 'time'], how='left'), dfs)
+    # Pixels that don't belong to any region are marked with -1. The others
+    # get the position of their region in the sorted region codes.
+    region = zones.region_code.transpose('y', 'x')
+    valid = region.values >= 0
+    region_codes, region_index = np.unique(region.values[valid], return_inverse=True)
+    n_regions = len(region_codes)
+
+    region_pos = np.full(region.shape, -1, dtype=np.int64)
+    region_pos[valid] = region_index
+    region = region.copy(data=region_pos)
+
+    n_bins = len(labels) + 1
+
+    # Bins, regions and the sums run as a single task per chunk of time steps
+    counts = xr.apply_ufunc(reduce_chunk,
+                            ghsl.population,
+                            bin_idx,
+                            region,
+                            kwargs={'n_regions': n_regions, 'n_bins': n_bins},
+                            input_core_dims=[['y', 'x'], ['y', 'x'], ['y', 'x']],
+                            output_core_dims=[['region', 'bin']],
+                            dask='parallelized',
+                            output_dtypes=[np.float64],
+                            dask_gufunc_kwargs={'output_sizes': {'region': n_regions, 'bin': n_bins},
+                                                'allow_rechunk': True})
+
+    counts = counts.transpose('time', 'region', 'bin')
+    times = counts.time.values
+    counts = counts.values
+
+    merged = pd.DataFrame({
+        "region_code": np.tile(region_codes, len(times)),
+        "time": np.repeat(times, n_regions),
+        "total_population": counts.sum(axis=2).ravel(),
+    })
 
-    # Remove redundant columns
-    merged = merged.drop(columns=[col for col in merged.columns if '_x' in col or '_y' in col])
+    for i, label in enumerate(labels, start=1):
+        merged[f"affected_population_{label}"] = counts[:, :, i].ravel()
     
     return merged
 
@@ -337,15 +346,23 @@ def compute_pollution_average(pm2p5, zones):
     # Attributes a zone to each population grid
     pm2p5['region_code'] = zones.region_code
         
-    # Creates a groupby over region and turns it into a dataframe
+    # Creates a groupby over region. flox reduces all the groups in one pass, chunk by chunk.
     avg_pollution = pm2p5.groupby("region_code")\
-                        .mean()\
+                        .mean(method="map-reduce", engine="numba")\
                         .pm2p5_mean\
-                        .to_dataframe()\
-                        .reset_index()
-
-    # Renames columns to avoid merge issues
-    avg_pollution = avg_pollution.rename(columns={"population":"total_population"})
+                        .transpose('time', 'region_code')
+
+    # Drops the pixels that don't belong to any region
+    region_codes = avg_pollution.region_code.values
+    keep = region_codes >= 0
+
+    # Turns it into a dataframe straight from the arrays, one row per time step and region
+    times = avg_pollution.time.values
+    avg_pollution = pd.DataFrame({
+        "time": np.repeat(times, keep.sum()),
+        "region_code": np.tile(region_codes[keep], len(times)),
+        "pm2p5_mean": avg_pollution.values[:, keep].ravel(),
+    })
 
     return avg_pollution
 
@@ -391,125 +408,204 @@ def bin_pollution(df):
               'Very poor (50-75)', 
               'Extremely poor (75-800)']
 
-    # Use pd.cut() to categorize values
-    df['EU_category'] = pd.cut(df['pm2p5_mean'], bins=bins, labels=labels, include_lowest=True)
+    # Categorizes values, like pd.cut() would
+    df['EU_category'] = cut(df['pm2p5_mean'], bins=bins, labels=labels)
 
     # Repeats for WHO levels
     bins = [0, 15, 25, 37.5, 50, 75, 800]
     labels = ["AQG level (0-15)", "Interim target 4 (15-25)" , 
               "Interim target 3 (25-37.5)", "Interim target 2 (37.5-50)", 
               "Interim target 1 (50-75)", "Over interim targets (75+)"]
-    df['WHO_category'] = pd.cut(df['pm2p5_mean'], bins=bins, labels=labels, include_lowest=True)
+    df['WHO_category'] = cut(df['pm2p5_mean'], bins=bins, labels=labels)
     
     return df
 
 
-def compute(nuts_level, timestep, year):
+def read_nuts(nuts_level):
     '''
-    This will craete a dataframe with mean pollution levels
-    for each region in a given day, as well as the classification
-    according to WHO and EU air quality guidelines.
+    Reads the NUTS regions of the given level,
+    with the region codes that get_zones assigns.
     '''
-    
-    print("Starting the script...")
-    start_time = time.time()
-    
-    
-    ######################
-    #### Reading NUTS ####
-    ######################
-    
+
     print("Reading nuts file")
     with timer('Reading NUTS file took'):
 
         # Keep only the NUTS level of interest
-        nuts = gpd.read_file("../output/NUTS/expanded-NUTS.json")
+        nuts = gpd.read_parquet(NUTS_PATH)
         nuts = nuts[nuts.LEVL_CODE==nuts_level].reset_index()
 
-    ##################################
-    #### Preparing pollution data ####
-    ##################################
-    
-    print("Reading and processing pollution data")
-    with timer("Reading and processing pollution data took"):
-    
-        pm2p5_path = "../output/5.europe-forecast-reprojected.netcdf"
+        # Same region codes that get_zones assigns
+        nuts['region_code'] = pd.Categorical(nuts['NUTS_ID']).codes.astype(np.int32)
+
+    return nuts
+
 
-        print("Reading...")
-        pm2p5 = xr.open_dataset(pm2p5_path, decode_coords='all')
+def prepare_pollution(year, timestep):
+    '''
+    Resamples the pm2p5 data of a year to the given timestep
+    and rescales it to fit in NUTS units.
+    '''
 
-        # Keeps only the relevant year
-        pm2p5 = pm2p5.sel(time=year)
+    pm2p5_path = "../output/5.europe-forecast-reprojected.zarr"
 
-        # Now let's resample it
-        print("Resampling...")
-        pm2p5 = pm2p5.resample(time=timestep).mean()
+    # The forecast data keeps being downloaded, so the cache also
+    # depends on when the source store was last written
+    pm2p5_cache = get_cache_path(f"pm2p5-{year}-{timestep}", (year, timestep, os.path.getmtime(pm2p5_path)))
+
+    if os.path.exists(pm2p5_cache):
+
+        print("Reading cached pollution data")
+        pm2p5 = xr.open_zarr(pm2p5_cache, decode_coords='all')
+
+    else:
+
+        print("Reading and processing pollution data")
+        with timer("Reading and processing pollution data took"):
+
+            # Opens the data lazily, in dask chunks, so the steps below
+            # run chunk by chunk instead of on the whole cube at once
+            print("Reading...")
+            pm2p5 = xr.open_zarr(pm2p5_path, consolidated=True, decode_coords='all', chunks={'time': 24, 'x': 512, 'y': 512})
+
+            # Keeps only the variable and coordinates that are used below.
+            # spatial_ref holds the CRS that rioxarray needs.
+            pm2p5 = pm2p5[['pm2p5_mean']]
+            pm2p5 = pm2p5.drop_vars([coord for coord in pm2p5.coords if coord not in ('x', 'y', 'time', 'spatial_ref')])
+
+            # Single precision is more than enough for pm2.5 concentrations
+            pm2p5 = pm2p5.astype(np.float32)
+
+            # Keeps only the relevant year
+            pm2p5 = pm2p5.sel(time=year)
+
+            # Now let's resample it, keeping the result in the workers' memory
+            # so it's computed only once for the steps below
+            print("Resampling...")
+            pm2p5 = pm2p5.resample(time=timestep).mean().persist()
 
     
-    print("Rescaling population data")
-    with timer('Rescaling pollution data took'):
-        #### Rescale the pm2p5 data to fit in NUTS units
-        pm2p5 = rescale(raster=pm2p5,
-                        factor=3,
-                        algorithm=Resampling.nearest)
-
-                   
-    ###################################
-    #### Preparing population data ####
-    ###################################
-    
+        print("Rescaling population data")
+        with timer('Rescaling pollution data took'):
+            #### Rescale the pm2p5 data to fit in NUTS units
+            pm2p5 = rescale(raster=pm2p5,
+                            factor=3,
+                            algorithm=Resampling.nearest)
+
+        # Saves the result for the other runs with the same year and timestep
+        pm2p5 = save_cache(pm2p5, pm2p5_cache, chunks={'time': 24, 'x': 512, 'y': 512})
+
+    return pm2p5
+
+
+def prepare_population(pm2p5):
+    '''
+    Reprojects the GHSL population grid to match the rescaled pm2p5 grid.
+    '''
+
+    ghsl_path = "../output/5.ghsl-europe-forecast-reprojected.zarr"
+
+    # The reprojected grid depends on the source store and on the grid it's drawn on
+    ghsl_key = (os.path.getmtime(ghsl_path), tuple(pm2p5.rio.transform()), pm2p5.rio.shape)
+    ghsl_cache = get_cache_path("ghsl", ghsl_key)
+
     print("Preparing GHSL data")
     with timer("Prepring GHSL data took"):
     
-        print("Opening...")
-        # Get's the ghsl data
-        ghsl = xr.open_dataset("../output/5.ghsl-europe-forecast-reprojected.netcdf", decode_coords='all')
-        
-        print("Reprojecting to match...")
-        #### Reproject the population data so it matches the rescaled pm2p5 data
-        ghsl = reproject_to_match(source=ghsl, target=pm2p5)
-
-        print("Assigning coords...")
-        # They are already in the same dimensions. We can simply assign coords.
-        ghsl = ghsl.assign_coords({"x": pm2p5.x, "y": pm2p5.y})
-
-        print("Renaming variables...")
-        # Rename columns so it makes better sense
-        ghsl = ghsl.rename({"band_data": "population"})
-
-        # Saves pm2p5 to access pixel data
-        # ghsl.to_netcdf(f"../output/8-ghsl-pm2p5-{year}.netcdf")
-
-        print("Assigning a time dimension...")
-        # GHSL needs a time dimensions similar to pm2p5    
-        steps = pm2p5.time.values
-        ghsl = ghsl.expand_dims(time=steps)
-        ghsl = ghsl.assign_coords({"x": pm2p5.x, "y":pm2p5.y, "time":pm2p5.time})
+        if os.path.exists(ghsl_cache):
+
+            print("Reading cached GHSL data")
+            ghsl = xr.open_zarr(ghsl_cache, decode_coords='all')
+
+        else:
+
+            print("Opening...")
+            # Get's the ghsl data
+            ghsl = xr.open_zarr(ghsl_path, consolidated=True, decode_coords='all', chunks={'x': 512, 'y': 512})
+
+            # Same for the population grid
+            ghsl = ghsl[['band_data']]
+            ghsl = ghsl.drop_vars([coord for coord in ghsl.coords if coord not in ('x', 'y', 'band', 'spatial_ref')])
+
+            # Population counts per cell fit in single precision too
+            ghsl = ghsl.astype(np.float32)
         
+            print("Reprojecting to match...")
+            #### Reproject the population data so it matches the rescaled pm2p5 data
+            ghsl = reproject_to_match(source=ghsl, target=pm2p5)
 
+            print("Assigning coords...")
+            # They are already in the same dimensions. We can simply assign coords.
+            ghsl = ghsl.assign_coords({"x": pm2p5.x, "y": pm2p5.y})
 
+            print("Renaming variables...")
+            # Rename columns so it makes better sense
+            ghsl = ghsl.rename({"band_data": "population"})
 
+            # The population grid has a single band
+            ghsl = ghsl.squeeze('band', drop=True)
+
+            # The reprojected grid is the same for every run, so it's saved once
+            ghsl = save_cache(ghsl, ghsl_cache, chunks={'x': 512, 'y': 512})
+
+    return ghsl
+
+
+def prepare_zones(nuts, nuts_level, pm2p5):
+    '''
+    Marks each pixel of the rescaled pm2p5 grid with the region it belongs to.
+    '''
+
+    # The zones depend on the NUTS level, on the NUTS file the region codes
+    # come from and on the grid they are drawn on
+    zones_key = (nuts_level, os.path.getmtime(NUTS_PATH), tuple(pm2p5.rio.transform()), pm2p5.rio.shape)
+    zones_cache = get_cache_path(f"zones-NUTS{nuts_level}", zones_key)
 
-    #######################
-    #### Compute zones ####
-    #######################
-    
     print("Creating zones")
     with timer('Creating zones took'):
-        zones, corresp = get_zones(raster=pm2p5,
-                                  vector=nuts,
-                                  varname='pm2p5_mean',
-                                  keyname='region_code',
-                                  )
-    
-    ########################
-    #### Creating masks ####
-    ########################
+
+        if os.path.exists(zones_cache):
+
+            print("Reading cached zones")
+            zones = xr.open_zarr(zones_cache, decode_coords='all')
+
+        else:
+
+            zones, corresp = get_zones(raster=pm2p5,
+                                      vector=nuts.copy(),
+                                      varname='pm2p5_mean',
+                                      keyname='region_code',
+                                      )
+
+            zones = save_cache(zones, zones_cache, chunks={'x': 512, 'y': 512})
+
+        # The zone grid is small, and grouping by a chunked array
+        # needs its labels in advance, so it's kept in memory
+        zones = zones.load()
+
+    return zones
+
+
+def compute(nuts, zones, pm2p5, ghsl, timestep, year):
+    '''
+    This will craete a dataframe with mean pollution levels
+    for each region in a given day, as well as the classification
+    according to WHO and EU air quality guidelines.
+    '''
+
+    print(f"Computing {timestep} data for {year}...")
+
+    # GHSL stays a single 2-D grid, which is broadcast over the time steps
+    # of pm2p5 when needed, instead of being copied once for each of them
+    ghsl = ghsl.assign_coords({"x": pm2p5.x, "y":pm2p5.y})
+
+    #######################
+    #### Creating bins ####
+    #######################
     
-    print("Making masks")
-    with timer("Making masks took"):
-        # Masks are increasing steps of the WHO threshold
-        masks, labels = get_masks(pm2p5)
+    print("Making bins")
+    with timer("Making bins took"):
+        # Bins are increasing steps of the WHO threshold
+        bin_idx, labels = get_bins(pm2p5)
 
     ##########################################
     #### Creates the population dataframe ####
@@ -518,7 +614,7 @@ def compute(nuts_level, timestep, year):
     if timestep == 'Y' and year == '2022':
         print("Calculating population shares")
         with timer('Calculating population shares took'):
-            population_gdf = compute_affected_population(ghsl, zones, masks, labels)
+            population_gdf = compute_affected_population(ghsl, zones, bin_idx, labels)
     
     #########################################
     #### Creates the pollution dataframe ####
@@ -542,7 +638,7 @@ def compute(nuts_level, timestep, year):
     #### Adds NUTS info ####
     ########################
     
-    nuts['region_code'] = nuts['NUTS_ID'].map(corresp)
+    # read_nuts already set the region codes on nuts
     
     if timestep == 'Y' and year == '2022':
         result = population_gdf.merge(pollution_gdf, on=['region_code', 'time'])
@@ -558,24 +654,15 @@ def compute(nuts_level, timestep, year):
                  "NAME_LATN", "geometry"]].merge(result, on=['region_code'])
     
 
-    # Rounds values
-    for column in result.columns:
-        if '_population' in column:
-            result[column] = result[column].round()
-            
-        if 'percentage_' in column:
-            result[column] = result[column].fillna(0)
-            result[column] = result[column]
-            
-        if 'mean' in column:
-            result[column] = result[column]
-    
-          
-    result = result.drop(columns=[col for col in result.columns if '_y' in col 
-                                                                or '_x' in col 
-                                                                or 'band' in col
-                                                                or 'geometry' in col
-                                                                or 'spatial_ref' in col])
+    # Rounds values, one block of columns at a time
+    population_columns = result.columns[result.columns.str.contains('_population')]
+    result[population_columns] = result[population_columns].round()
+
+    percentage_columns = result.columns[result.columns.str.contains('percentage_')]
+    result[percentage_columns] = result[percentage_columns].fillna(0)
+
+    drop_columns = result.columns[result.columns.str.contains('_y|_x|band|geometry|spatial_ref')]
+    result = result.drop(columns=drop_columns)
     #result = result.fillna(0)
     
     return result
@@ -583,26 +670,50 @@ def compute(nuts_level, timestep, year):
 
 def main():
 
-    # Compute the whole thing for 2023
-    df_2023 = compute(nuts_level=3, year='2023', timestep='1D') # Daily data for 2023, level 3
-    df_2023.to_csv(f"../output/csvs/forecast-classified-NUTS3-1D-2023.csv", index=False)
+    # Local dask cluster for the chunked computations, with a single thread
+    # per core. The numba kernel runs on one thread inside each worker, since 
+    # the workers already use all the cores between them.
+    client = Client(n_workers=os.cpu_count(), 
+                    threads_per_worker=1,
+                    env={'NUMBA_NUM_THREADS': '1'})
+
+    # The NUTS level, year and timestep of each output
+    runs = [(3, '2023', '1D'), # Daily data for 2023, level 3
+            (3, '2023', 'W'), # Weekly data for 2023, level 3
+            (3, '2022', 'Y'), # Level 3 yearly and daily data for 2022
+            (3, '2022', '1D'),
+            (0, '2022', 'Y')] # Level 0 yearly data for 2022
+
+    # Each input is prepared by a single task, which the runs that need it share
+    nuts = {nuts_level: dask.delayed(read_nuts)(nuts_level) 
+            for nuts_level, year, timestep in runs}
+
+    pm2p5 = {(year, timestep): dask.delayed(prepare_pollution)(year, timestep) 
+             for nuts_level, year, timestep in runs}
 
-    df_2023 = compute(nuts_level=3, year='2023', timestep='W') # Weekly data for 2023, level 3
-    df_2023.to_csv(f"../output/csvs/forecast-classified-NUTS3-W-2023.csv", index=False)
+    # The rescaled grid is the same for every year and timestep
+    grid = pm2p5[runs[0][1:]]
 
+    ghsl = dask.delayed(prepare_population)(grid)
 
-    # Level 3 yearly and daily data for 2022
-    df_2022_3_y = compute(nuts_level=3, year='2022', timestep='Y')
-    df_2022_3_y.to_csv(f"../output/csvs/forecast-classified-NUTS3-Y-2022.csv", index=False)
+    zones = {nuts_level: dask.delayed(prepare_zones)(nuts[nuts_level], nuts_level, grid) 
+             for nuts_level in nuts}
 
-    df_2022_3_d = compute(nuts_level=3, year='2022', timestep='1D')
-    df_2022_3_d.to_csv(f"../output/csvs/forecast-classified-NUTS3-1D-2022.csv", index=False)
+    results = [dask.delayed(compute)(nuts[nuts_level], 
+                                     zones[nuts_level], 
+                                     pm2p5[(year, timestep)], 
+                                     ghsl, 
+                                     timestep, 
+                                     year) 
+               for nuts_level, year, timestep in runs]
 
+    # The pipeline runs in local threads, which send their
+    # chunked computations to the cluster
+    results = dask.compute(*results, scheduler='threads')
 
-    # Level 0 yearly data for 2022
-    df_2022_0 = compute(nuts_level=0, year='2022', timestep='Y')
-    df_2022_0.to_csv(f"../output/csvs/forecast-classified-NUTS0-Y-2022.csv", index=False)
+    for (nuts_level, year, timestep), df in zip(runs, results):
+        save_csv(df, f"../output/csvs/forecast-classified-NUTS{nuts_level}-{timestep}-{year}.csv")
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -5,15 +5,20 @@ countries and NUTS regions at differente time intervals,
 as well as pm2p5 averages throughout the area.
 '''
 
-from functools import reduce
-from geocube.api.core import make_geocube
+import dask
 import geopandas as gpd
+import hashlib
+from helpers import get_bins, save_csv
+from kernels import accumulate_affected
 import matplotlib.pyplot as plt
 import matplotlib.colors as colors
 import numpy as np
+import os
 from os.path import isfile
 import pandas as pd
 from rasterio.enums import Resampling
+from rasterio.features import rasterize
+from reduce import save_zarr
 import rioxarray
 import xarray as xr
 import time
@@ -25,6 +30,12 @@ import warnings
 
 pd.options.mode.chained_assignment = None  # default='warn'
 warnings.simplefilter(action='ignore', category=FutureWarning)
+# xarray hands the groupby and resample reductions to flox, which must be installed
+xr.set_options(use_flox=True)
+
+# Zones already loaded in this run, keyed by NUTS level, NUTS file and grid.
+# The grid is the same for every timegroup, so each level is loaded once.
+ZONES_CACHE = {}
 
 #################
 #### HELPERS ####
@@ -58,10 +69,13 @@ def rescale(raster, factor, algorithm):
     new_width = int(raster.rio.width * factor)
     new_height = int(raster.rio.height * factor)
 
+    # Warps on all the cores, with a 512 MB working buffer (warp_mem_limit is in MB)
     raster = raster.rio.reproject(
         raster.rio.crs,
         shape=(new_height, new_width),
         resampling=algorithm,
+        num_threads=os.cpu_count(),
+        warp_mem_limit=512,
     )
 
 
@@ -107,23 +121,68 @@ def get_zones(raster, vector, varname, keyname='region_code'):
     raster = raster[varname]
         
     # Creates a key to mark the grid cells with
-    vector[keyname] = range(0, vector.shape[0]) # in geocube, the ids need to be numbers :/
+    vector[keyname] = np.arange(vector.shape[0], dtype=np.int32) # the ids need to be numbers :/
       
     # A correspondence dict for easier access
-    corresp = {row["NUTS_ID"]: row[keyname] for index, row in vector[[keyname, 'NUTS_ID']].iterrows()}
+    corresp = dict(zip(vector['NUTS_ID'].to_numpy(), vector[keyname].to_numpy()))
     
+    # Stamps the ids of the shapes straight into an int32 grid with the shape
+    # of the raster. Pixels outside of all polygons are marked with -1.
+    shapes = zip(vector.to_crs(raster.rio.crs).geometry.values, vector[keyname].to_numpy())
+    codes = rasterize(shapes,
+                      out_shape=(raster.rio.height, raster.rio.width),
+                      transform=raster.rio.transform(),
+                      fill=-1,
+                      dtype='int32')
+
     # Creates an output grid – that is, an xarray representation of the vector data
-    # but with no values associated
-    outgrid = make_geocube(
-        vector_data=vector, # The shapes that we will use as a mold
-        measurements=[keyname], # This is the LABEL we will stamp the pixels with
-        like=raster, # The new cube will have the shape of the raster
-    )
+    outgrid = xr.Dataset({keyname: (("y", "x"), codes)}, coords={"y": raster.y, "x": raster.x})
+    outgrid = outgrid.rio.write_crs(raster.rio.crs)
     
     return outgrid, corresp
 
 
 
+def get_cached_zones(raster, vector, nuts_path, nuts_level):
+    '''
+    Returns the zones and correspondence dict of get_zones, rasterizing
+    them only once. They are saved to a zarr store keyed by a hash of the
+    NUTS level, the NUTS file and the grid, so the following runs read them
+    from there instead. save_zarr only moves the store to its path once
+    it's complete, so an interrupted write is never read as zones.
+    '''
+
+    zones_key = (nuts_level, os.path.getmtime(nuts_path), tuple(raster.rio.transform()), raster.rio.shape)
+
+    if zones_key not in ZONES_CACHE:
+
+        zones_hash = hashlib.md5(repr(zones_key).encode()).hexdigest()[:12]
+        zones_cache = f"../output/cache/zones-reanalysis-NUTS{nuts_level}-{zones_hash}.zarr"
+
+        if os.path.exists(zones_cache):
+
+            print("Reading cached zones...")
+            zones = xr.open_zarr(zones_cache, decode_coords='all').load()
+
+            # Same ids that get_zones gives to the shapes
+            corresp = dict(zip(vector['NUTS_ID'].to_numpy(), np.arange(vector.shape[0], dtype=np.int32)))
+
+        else:
+
+            zones, corresp = get_zones(raster=raster,
+                                       vector=vector,
+                                       varname='pm2p5_mean',
+                                       keyname='region_code',
+                                      )
+
+            os.makedirs(os.path.dirname(zones_cache), exist_ok=True)
+            save_zarr(zones, zones_cache, chunks={'x': 512, 'y': 512})
+
+        ZONES_CACHE[zones_key] = zones, corresp
+
+    return ZONES_CACHE[zones_key]
+
+
 def reproject_to_match(source, target):
     """
     Reprojects the source raster to match the target raster's shape, resolution, and coordinates.
@@ -142,8 +201,12 @@ def reproject_to_match(source, target):
     -----
     This docstring was created with the help of GPT-4, an AI language model developed by OpenAI.
     """
-    # Reprojects the source raster to match the target raster
-    rpjct = source.rio.reproject_match(target, resampling=Resampling.sum)
+    # Reprojects the source raster to match the target raster,
+    # on all the cores and with a 512 MB warp buffer (warp_mem_limit is in MB)
+    rpjct = source.rio.reproject_match(target, 
+                                       resampling=Resampling.sum,
+                                       num_threads=os.cpu_count(),
+                                       warp_mem_limit=512)
 
     # Assigns the coordinates from the target raster to the reprojected source raster to avoid rounding errors
     rpjct = rpjct.assign_coords({
@@ -154,156 +217,73 @@ def reproject_to_match(source, target):
     return rpjct
 
 
-def get_masks(pm2p5, thresholds=[0, 5, 10, 15, 20, 25]):
-    '''
-    Generates a list of masks and corresponding labels for an input dataarray.
-    
-    Each mask corresponds to a range of values defined by the thresholds. For instance,
-    the first mask will cover the range from thresholds[0] to thresholds[1], the second
-    mask will cover the range from thresholds[1] to thresholds[2], and so on. The masks
-    can be used to filter the dataarray for values within specific ranges.
-    
-    The last mask will cover the range from the last threshold to infinity.
-    
-    Parameters
-    ----------
-    pm2p5 : xarray.DataArray
-        The input dataarray from which the masks are to be generated.
-        This array should represent the pm2.5 concentration data.
-    thresholds : list, optional
-        The list of thresholds defining the ranges for which masks are to be generated.
-        Default is [0, 5, 10, 15, 20, 25].
-    
-    Returns
-    -------
-    masks : list of xarray.DataArray
-        The list of generated masks. Each mask corresponds to a range of values.
-    labels : list of str
-        The list of labels corresponding to each mask. Each label represents the
-        range of values that the corresponding mask covers.
-    
-    Example
-    -------
-    masks, labels = get_masks(pm2p5)
-    for mask, label in zip(masks, labels):
-        print(f"For range {label}, there are {mask.sum()} cells.")
-    '''
-    
-    # Initialize an empty list for the masks
-    masks = []
-
-    # Initialize an empty list for the labels
-    labels = []
-
-    # Iterate over the thresholds
-    for i in range(len(thresholds) - 1):
-        # Create a mask for each range
-        mask = (pm2p5.pm2p5_mean >= thresholds[i]) & (pm2p5.pm2p5_mean < thresholds[i+1])
-
-        # Append the mask to the list
-        masks.append(mask)
-
-        # Create a label for each range
-        label = f"{thresholds[i]}-{thresholds[i+1]}"
-
-        # Append the label to the list
-        labels.append(label)
-
-    # Create a mask for the last threshold ("25+")
-    mask = (pm2p5.pm2p5_mean >= thresholds[-1])
-    masks.append(mask)
-    labels.append(f"{thresholds[-1]}+")
-    
-    return masks, labels
-
-
-def compute_affected_population(ghsl, zones, masks, labels):
+def compute_affected_population(ghsl, zones, bin_idx, labels):
     """
     Computes the total affected population in each region for various ranges of pollution.
     
-    This function uses a list of masks to filter the population data for specific ranges of 
-    pollution. For each mask, the function calculates the sum of the population in areas where 
-    the pollution level falls within the range that the mask represents. The function also 
-    computes the total population per region without applying any masks. The function outputs 
-    a dataframe where each column represents the total affected population for a specific range
-    of pollution levels, along with a column for the total population per region.
+    Each pixel comes with the range of values its pollution level falls in, as computed by
+    get_bins. For each time step, a compiled kernel goes over the pixels once and adds 
+    the population of each pixel to its range and region – instead of filtering and 
+    grouping the whole population grid once for each range. The total population per region is the sum of all ranges, including the pixels 
+    that fall in none of them. The function outputs a dataframe where each column represents
+    the total affected population for a specific range of pollution levels, along with a
+    column for the total population per region.
     
     Parameters
     ----------
-    ghsl : xarray.DataArray
-        A data array representing the global human settlement layer (GHSL) population grid.
+    ghsl : xarray.Dataset
+        A dataset with the global human settlement layer (GHSL) population grid as 'population'.
+        The grid is 2-D, and it's used for every time step.
     zones : xarray.Dataset
         A dataset representing the different regions/zones.
-    masks : list of xarray.DataArray
-        A list of masks representing the different ranges of pollution. Each mask should 
-        correspond to a range of pollution levels.
+    bin_idx : xarray.DataArray
+        An integer dataarray with the range of pollution levels each pixel falls in,
+        as returned by get_bins.
     labels : list of str
-        A list of labels for each mask. Each label should represent the range of pollution 
-        levels that the corresponding mask covers.
+        A list of labels for bins 1 and up. Each label should represent the range 
+        of pollution levels that the corresponding bin covers.
     
     Returns
     -------
     merged : pandas.DataFrame
         A dataframe where each column represents the total affected population for a specific 
         range of pollution levels, along with a column for the total population per region.
-        The index of the dataframe represents the region codes.
+        Each row represents one region code and time step.
     """
 
-    # Re-assign the coordinates to match the zones
-    ghsl = ghsl.assign_coords({"x": zones["x"], "y": zones["y"]})
-    
-    # Attributes a zone to each population grid
-    ghsl['region_code'] = zones.region_code
-
-    # Calculate the total population per region without applying any masks
-    total_pop = ghsl.groupby("region_code").sum().population.to_dataframe().reset_index()
-    total_pop = total_pop.rename(columns={"population": "total_population"})
-
-    # Generate a list to store the dataframes
-    dfs = [total_pop]
-
-    # For each mask in the list
-    for mask, label in zip(masks, labels):
-        
-        print(f"Processing mask: {label}")
-        
-        # Assign coordinates to mask
-        mask = mask.assign_coords({"x": ghsl.x, "y": ghsl.y, "time": ghsl.time})
-        
-        # Applies the mask
-        masked_ghsl = ghsl.where(mask)
-        
-        # The region code always should persist, even if the 
-        # mask applies to it. The population values are the only ones
-        # that should be filtered.
-        masked_ghsl["region_code"] = ghsl.region_code
-        
-        print("attempting xarray groupby")
-        # Apply the mask to the data
-        affected_pop = (masked_ghsl
-                            .groupby("region_code")
-                            .sum()
-                            .population)
-        
-        #display(affected_pop)
-        print("attempting convertion to dataframe")
-        affected_pop = (affected_pop.to_dataframe()
-                                    .reset_index())
-        
-        #display(affected_pop)
-                
-        # Rename the column to reflect the range of values it represents
-        affected_pop = affected_pop.rename(columns={"population":f"affected_population_{label}"})
-        
-        print("appending")
-        # Append to the list of dataframes
-        dfs.append(affected_pop)
-
-    # Merge all dataframes
-    merged = reduce(lambda left,right: pd.merge(left,right, on=['region_code', 'time'], how='left'), dfs)
+    # Pixels that don't belong to any region are left out. The others
+    # get the position of their region in the sorted region codes.
+    region = zones.region_code.transpose('y', 'x').values
+    valid = region >= 0
+    region_codes, region_index = np.unique(region[valid], return_inverse=True)
+    n_regions = len(region_codes)
+
+    # Bin 0 holds the pixels below the first threshold or without pollution
+    # data, which only count for the total population
+    n_bins = len(labels) + 1
+
+    # The population doesn't change over time, so it's read only once
+    population = np.nan_to_num(ghsl.population.transpose('y', 'x').values)[valid]
+    bins = bin_idx.transpose('time', 'y', 'x').values
+
+    times = bin_idx.time.values
+    counts = np.empty((len(times), n_regions, n_bins))
+
+    for t in range(len(times)):
+        counts[t] = accumulate_affected(population, 
+                                        region_index, 
+                                        bins[t][valid], 
+                                        n_regions,
+                                        n_bins)
+
+    merged = pd.DataFrame({
+        "region_code": np.tile(region_codes, len(times)),
+        "time": np.repeat(times, n_regions),
+        "total_population": counts.sum(axis=2).ravel(),
+    })
 
-    # Remove redundant columns
-    merged = merged.drop(columns=[col for col in merged.columns if '_x' in col or '_y' in col])
+    for i, label in enumerate(labels, start=1):
+        merged[f"affected_population_{label}"] = counts[:, :, i].ravel()
     
     return merged
 
@@ -339,18 +319,23 @@ def compute_pollution_average(pm2p5, zones):
     # Attributes a zone to each population grid
     pm2p5['region_code'] = zones.region_code
     
-    # Creates a groupby over region and turns it into a dataframe
+    # Creates a groupby over region and turns it into a dataframe.
+    # flox reduces all the groups in one pass, chunk by chunk.
     avg_pollution = pm2p5.groupby("region_code")\
-                        .mean()\
+                        .mean(method="map-reduce", engine="numba")\
                         .pm2p5_mean\
                         .to_dataframe()\
                         .reset_index()
 
+    # Drops the pixels that don't belong to any region
+    avg_pollution = avg_pollution[avg_pollution.region_code >= 0]
+
     # Renames columns to avoid merge issues
     avg_pollution = avg_pollution.rename(columns={"population":"total_population"})
 
     return avg_pollution
 
+
 ###################################
 #### Main computation function ####
 ###################################
@@ -364,18 +349,23 @@ def compute(
          time_slice,
 ):
 
-        
+
     # Output path
     csv_path = f"../output/csvs/reanalysis-NUTS{nuts_level}-{timegroup}.csv"
-    if isfile(csv_path):
-        print("File already present. Skipping.")
-        return
 
     
     print("Reading data...")
-    pm2p5 = xr.open_dataset(pm2p5_path, decode_coords='all')
-    ghsl = xr.open_dataset(ghsl_path, decode_coords='all').squeeze()
-    nuts = gpd.read_file(nuts_path)
+    # Opens the data lazily, in the chunks it's stored with, so
+    # the steps below run chunk by chunk and on all cores
+    pm2p5 = xr.open_zarr(pm2p5_path, consolidated=True, decode_coords='all')
+
+    # Single precision is more than enough for pm2.5 concentrations
+    pm2p5 = pm2p5.astype(np.float32)
+    ghsl = xr.open_zarr(ghsl_path, consolidated=True, decode_coords='all')
+
+    # The population grid has a single band, and its counts fit in single precision
+    ghsl = ghsl.squeeze('band', drop=True).astype(np.float32)
+    nuts = gpd.read_parquet(nuts_path)
     
     print("Filtering time...")
     #### Keeps only observations in the time slice
@@ -389,9 +379,10 @@ def compute(
     # Keep only the NUTS level of interest
     nuts = nuts[nuts.LEVL_CODE==nuts_level].reset_index()
     
-    #### Compute yearly average for pm2p5, if needed
+    #### Compute yearly average for pm2p5, if needed.
+    #### flox does the time groups with a single numba kernel per chunk.
     print("Computing average...")
-    pm2p5 = pm2p5.resample(time=timegroup).mean()
+    pm2p5 = pm2p5.resample(time=timegroup).mean(engine="numba").astype(np.float32, copy=False)
     
     #### Rescale the pm2p5 data to fit in NUTS units, if needed
     print("Rescaling...")
@@ -402,30 +393,32 @@ def compute(
     
     #### Use the 'cookie cutter' to attribute a country value to pm2p5 grid
     print("Getting zones...")
-    zones, corresp = get_zones(raster=pm2p5,
-                      vector=nuts,
-                      varname='pm2p5_mean',
-                      keyname='region_code',
-                     )
+    zones, corresp = get_cached_zones(raster=pm2p5,
+                                      vector=nuts,
+                                      nuts_path=nuts_path,
+                                      nuts_level=nuts_level)
     
     #### Reproject the population data so it matches the rescaled pm2p5 data
     print("Reprojecting GHSL...")
     ghsl = reproject_to_match(source=ghsl, target=pm2p5)
     
-    # GHSL needs a time dimensions similar to pm2p5
-    steps = pm2p5.time.values
-    ghsl = ghsl.expand_dims(time=steps)
-    ghsl = ghsl.assign_coords({"x": pm2p5.x, "y":pm2p5.y, "time":pm2p5.time})
+    # GHSL stays a single 2-D grid, which is used for every time step
+    # of pm2p5 instead of being copied once for each of them
+    ghsl = ghsl.assign_coords({"x": pm2p5.x, "y":pm2p5.y})
+
+    #### Runs all the pending lazy steps in a single pass
+    print("Loading data...")
+    pm2p5, ghsl = dask.compute(pm2p5, ghsl)
             
-    #### For each pixel, determine whether it passes the threshold
-    print("Making masks...")
-    masks, labels = get_masks(pm2p5)
+    #### For each pixel, determine the range of pollution it falls in
+    print("Making bins...")
+    bin_idx, labels = get_bins(pm2p5)
             
     #### Now we can use the thresholds, the population estimates and the zones
     #### to create our comparison
     print("Calculating population shares...")
     if timegroup != 'D':
-        population_gdf = compute_affected_population(ghsl, zones, masks, labels)
+        population_gdf = compute_affected_population(ghsl, zones, bin_idx, labels)
     
     #### Creates an average yearly pollution dataframe
     print("Calculating pollution averages..")
@@ -452,24 +445,16 @@ def compute(
         for label in labels:
             result[f"percentage_{label}"] = result[f"affected_population_{label}"] / result["total_population"]
 
-    # Rounds values
-    for column in result.columns:
-        if '_population' in column:
-            result[column] = result[column].round()
-            
-        if 'percentage_' in column:
-            result[column] = result[column]
-            
-        if 'mean' in column:
-            result[column] = result[column]
-    
-          
+    # Rounds the population counts, all at once
+    population_columns = [column for column in result.columns if '_population' in column]
+    result[population_columns] = np.round(result[population_columns].to_numpy())
+
     result = result.drop(columns=[col for col in result.columns if '_y' in col or '_x' in col or 'band' in col])
     result = result.fillna(0)
     
     print("Saving as csv")
     csv = result.drop(columns='geometry')
-    csv.to_csv(csv_path, index=False)
+    save_csv(csv, csv_path)
     print()
     print("***")
                
@@ -479,7 +464,7 @@ def compute(
     #     "zones": zones,
     #     "ghsl": ghsl,
     #     "corresp": corresp,
-    #     "threshold_masks": (masks, labels)
+    #     "threshold_bins": (bin_idx, labels)
     # }
 
 
@@ -492,15 +477,21 @@ def main():
     # Europe reanalysis
     for timegroup in ['Y', 'D', 'W']:
         for nuts_level in  [0, 1, 3]:
+
+            # Skips the outputs that were already computed on a previous run
+            if isfile(f"../output/csvs/reanalysis-NUTS{nuts_level}-{timegroup}.csv"):
+                print(f"{timegroup} at NUTS level {nuts_level} already present. Skipping.")
+                continue
+
             print(f"Computing {timegroup} at NUTS level {nuts_level}")
             data = compute(
                 time_slice=(f"2018-01-01", f"2022-12-31"),
-                pm2p5_path = f"../output/5.europe-reanalysis-reprojected.netcdf",
+                pm2p5_path = f"../output/5.europe-reanalysis-reprojected.zarr",
                 pm2p5_source = 'europe-renalysis',
                 rescale_factor = 3,
-                nuts_path = "../output/NUTS/expanded-NUTS.json",
+                nuts_path = "../output/NUTS/expanded-NUTS.parquet",
                 nuts_level = nuts_level,
-                ghsl_path = "../output/5.ghsl-europe-reanalysis-reprojected.netcdf",
+                ghsl_path = "../output/5.ghsl-europe-reanalysis-reprojected.zarr",
                 timegroup=timegroup
             )
             print()
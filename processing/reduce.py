@@ -4,9 +4,14 @@ them in order to have a datapoint for each day instead of using
 all the hourly intervals.
 '''
 
+from concurrent.futures import ProcessPoolExecutor
+import dask
+from functools import partial
 import glob
+import os
 import pandas as pd
 import rioxarray as rxr
+import shutil
 import xarray as xr
 
 def get_files(pattern):
@@ -18,15 +23,6 @@ def get_files(pattern):
     return glob.glob(pattern)
 
 
-def concatenate(ds_list):
-    '''
-    Concatenates all the downloaded .netcdf files,
-    which are speciefied if the filenames array.
-    '''
-
-    return xr.concat(ds_list, dim='time').sortby('time')
-
-
 def resample(ds):
     '''
     Resamples the dataset data, creating one data variable
@@ -34,8 +30,8 @@ def resample(ds):
     observed in each day.
     '''
     
-    # orders the time so we can apply the daily average
-    ds = ds.sortby('time')
+    # No sorting here: the year is sorted by time
+    # once, right after its files are opened
 
     # uses resample to get the daily mean
     mean = ds.resample(time='1D').mean()
@@ -49,6 +45,27 @@ def resample(ds):
     return ds_resampled
 
 
+def preprocess(ds, data_type, year):
+    '''
+    Prepares each file as it's opened. Takes the opportunity to fix the time 
+    of the forecast data, which is in NANOSECONDS SINCE THE START DATE. 
+    Also renames columns and squeezes.
+    '''
+
+    if data_type == 'europe-forecast':
+
+        # Renames columns, which get the _mean suffix when resampled
+        ds = ds.rename({"pm2p5_conc": "pm2p5"})
+
+        # Squeezes on level
+        ds = ds.squeeze()
+
+        start_date = pd.Timestamp(f'{year}-01-01 00:00:00')
+        ds['time'] = start_date + pd.to_timedelta(ds['time'].values, unit='ns')
+
+    return ds
+
+
 def set_crs(ds):
     '''
     Sets a CRS for the naive raster file
@@ -57,88 +74,146 @@ def set_crs(ds):
 
 
 
-def main():
+def save_zarr(ds, path, chunks):
+    '''
+    Saves the dataset as a consolidated zarr store, in chunks
+    that match how the next steps of the pipeline read it.
+    Also used by reproject.py and the processing scripts.
+    '''
 
-    for data_type in ['europe-reanalysis', 'europe-forecast']:
+    # The encodings left by the source files don't apply to zarr,
+    # except for the link to the spatial_ref coordinate
+    ds = ds.copy()
+    for var in ds.variables.values():
+        var.encoding = {key: value for key, value in var.encoding.items() if key == 'grid_mapping'}
 
+    # Writes to a temporary store that is only moved into place once it's
+    # complete, so a store at path is never one that was cut off halfway.
+    # Its modification time is set to when the writing finished.
+    tmp_path = f"{path}.tmp"
+    ds.chunk(chunks).to_zarr(tmp_path, mode='w', consolidated=True)
+    os.utime(tmp_path)
 
-        if data_type == 'europe-reanalysis':
-            path = f"../data/CAMS-{data_type}/unzipped/reanalysis/"
-        elif data_type == 'europe-forecast':
-            path = f"../data/CAMS-{data_type}/raw/forecast/"
-        
+    if os.path.exists(path):
+        shutil.rmtree(path)
 
-        ### Some years have a slightly different grid cell which prevents proper concatenation
-        ### that we will have to take care of later (on 6.reproject.py)
-        for year in ["2018", "2019", "2020", "2021", "2022", "2023"]:
+    os.replace(tmp_path, path)
 
-            filenames = get_files(f"{path}/{year}-*.nc")
-            filenames = sorted(filenames)
 
-            ds_list = []
-            for filename in filenames:
+def is_up_to_date(output, inputs):
+    '''
+    Checks if the output was already written, after the last
+    change to any of the inputs it's made from. Also used by
+    reproject.py.
+
+    Stores written with save_zarr only exist once complete, and
+    their modification time is when the writing finished.
+    '''
+
+    if not os.path.exists(output):
+        return False
 
-                print("opening", filename)
-                ds = xr.open_dataset(filename)
+    written = os.path.getmtime(output)
 
-                print("resampling", filename)
-                ds = resample(ds)
-            
-                print("setting crs", filename)
-                ds = set_crs(ds)
+    return all(os.path.getmtime(path) < written for path in inputs if os.path.exists(path))
 
 
-                # Takes the opportunity to fix the time of the forecast data, which is in
-                # NANOSECONDS SINCE THE START DATE. Also renames columns and squeeze
-                if data_type == 'europe-forecast':
+def process_year(data_type, path, year, num_workers):
+    '''
+    Reduces all the files of a year to daily data
+    and saves them as a single zarr store, using
+    num_workers threads.
+    '''
 
+    # Caps the dask threads of this process, both to open the files and to save them
+    dask.config.set(scheduler='threads', num_workers=num_workers)
 
-                    # Renames columns
-                    print("renaming")
-                    ds = ds.rename({"pm2p5_conc_mean": "pm2p5_mean"})
+    filenames = get_files(f"{path}/{year}-*.nc")
+    filenames = sorted(filenames)
 
-                    # Squeezes on level
-                    print("squeezing")
-                    ds = ds.squeeze()
+    if len(filenames) == 0:
+        return
 
-                    print("Fixing time...")
-                    start_date = pd.Timestamp(f'{year}-01-01 00:00:00')
-                    ds['time'] = start_date + pd.to_timedelta(ds['time'].values, unit='ns')
+    # Opens all the files of the year at once, lazily and in parallel,
+    # so the steps below run as a single dask graph when saving
+    print("opening", path, year)
+    ds = xr.open_mfdataset(filenames, 
+                           combine='nested', 
+                           concat_dim='time', 
+                           parallel=True, 
+                           chunks={'time': 168},
+                           preprocess=partial(preprocess, data_type=data_type, year=year))
 
-                print("appending", filename)
-                ds_list.append(ds)
+    ds = ds.sortby('time')
 
+    print("resampling", year)
+    ds = resample(ds)
 
-            if len(ds_list) == 0:
-                continue
+    print("setting crs", year)
+    ds = set_crs(ds)
 
-            print("Concatenating...")
-            ds = concatenate(ds_list)
+    # Standardizes column names
+    print("Renaming...")
+    if data_type == 'europe-reanalysis':
+        print("lon lat to x y")
+        corresp = {'lon': 'x', 'lat': 'y'}
 
-            # Standardizes column names
-            print("Renaming...")
-            if data_type == 'europe-reanalysis':
-                print("lon lat to x y")
-                corresp = {'lon': 'x', 'lat': 'y'}
+    elif data_type == 'europe-forecast':
+        print("longitude latitude to x y")
+        corresp = {'longitude': 'x', 'latitude': 'y' }
 
-            elif data_type == 'europe-forecast':
-                print("longitude latitude to x y")
-                corresp = {'longitude': 'x', 'latitude': 'y' }
+    ds = ds.rename(corresp)
 
-            ds = ds.rename(corresp)
+    if data_type == 'europe-forecast':
+        print("Converting longitudes...")
+        # Converts lon from 0 to 360 to -180 to 180
+        ds = ds.assign_coords(x=(((ds.x + 180) % 360) - 180))
 
-            if data_type == 'europe-forecast':
-                print("Converting longitudes...")
-                # Converts lon from 0 to 360 to -180 to 180
-                ds = ds.assign_coords(x=(((ds.x + 180) % 360) - 180))
+    print(ds.coords)
 
-            print(ds.coords)
 
+    print("saving")
+    save_zarr(ds, f"../output/4.{data_type}-reduced-{year}.zarr", chunks={"time": 30, "y": 512, "x": 512})
 
-            print("saving")
-            ds.to_netcdf(f"../output/4.{data_type}-reduced-{year}.netcdf")
 
-    
+def main():
+
+    jobs = [ ]
+
+    for data_type in ['europe-reanalysis', 'europe-forecast']:
+
+
+        if data_type == 'europe-reanalysis':
+            path = f"../data/CAMS-{data_type}/unzipped/reanalysis/"
+        elif data_type == 'europe-forecast':
+            path = f"../data/CAMS-{data_type}/raw/forecast/"
+        
+
+        ### Some years have a slightly different grid cell which prevents proper concatenation
+        ### that we will have to take care of later (on 6.reproject.py)
+        for year in ["2018", "2019", "2020", "2021", "2022", "2023"]:
+
+            # Skips the years that were reduced after their last download,
+            # so the year that is still being downloaded is reduced again
+            filenames = get_files(f"{path}/{year}-*.nc")
+            if is_up_to_date(f"../output/4.{data_type}-reduced-{year}.zarr", filenames):
+                print(f"{data_type} {year} already reduced. Skipping.")
+                continue
+
+            jobs.append((data_type, path, year))
+
+    if not jobs:
+        return
+
+    # Each year is independent, so they run on their own cores. The cores
+    # are split between the years, so each process only starts its share
+    # of dask threads. Consuming the results raises any error from the workers.
+    max_workers = min(len(jobs), os.cpu_count())
+    num_workers = max(1, os.cpu_count() // max_workers)
+
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        list(pool.map(partial(process_year, num_workers=num_workers), *zip(*jobs)))
+
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
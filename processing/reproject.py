@@ -6,12 +6,28 @@ varations in 2022 and 2020 that produce unexpected
 results in the Europe Reanalysis dataset.
 '''
 
+import os
 from rasterio.enums import Resampling
+from reduce import is_up_to_date, save_zarr
 import rioxarray as rxr
 import xarray as xr
 
 
-def reproject_and_assign_coords(ds_target, ds_list):
+def get_grid(ds):
+    '''
+    Reads the destination grid (CRS, shape and transform) from
+    a dataset, so it can be shared by all the reprojections
+    instead of being derived again on each of them.
+    '''
+
+    return {
+        "dst_crs": ds.rio.crs,
+        "shape": (ds.rio.height, ds.rio.width),
+        "transform": ds.rio.transform(),
+    }
+
+
+def reproject_and_assign_coords(ds_target, ds_list, grid):
     """
     Reproject datasets in ds_list to match the spatial resolution and 
     coordinate system of ds_target.
@@ -19,6 +35,7 @@ def reproject_and_assign_coords(ds_target, ds_list):
     Parameters:
     - ds_target (xarray.Dataset): The target dataset to which the other datasets will be reprojected.
     - ds_list (list of xarray.Dataset): A list of datasets that need to be reprojected.
+    - grid (dict): The CRS, shape and transform of ds_target, as returned by get_grid.
 
     Returns:
     - list of xarray.Dataset: A list of reprojected datasets with coordinates matched to ds_target.
@@ -31,7 +48,9 @@ def reproject_and_assign_coords(ds_target, ds_list):
 
     for ds in ds_list:
         
-        ds_reprojected = ds.rio.reproject_match(ds_target)
+        ds_reprojected = ds.rio.reproject(**grid,
+                                          num_threads=os.cpu_count(), 
+                                          warp_mem_limit=512)
 
         ds_reprojected = ds_reprojected.assign_coords({"x": ds_target.x, "y": ds_target.y})
 
@@ -42,47 +61,88 @@ def reproject_and_assign_coords(ds_target, ds_list):
 
 
 
-def main():
+def get_years(data_type):
+    '''
+    Lists the years covered by each type of dataset.
+    '''
 
+    # Each type of dataset covers a different time range
+    if data_type == 'europe-reanalysis':
+        years = ["2018", "2019", "2020", "2021", "2022"]
 
-    for data_type in ['europe-reanalysis', 'europe-forecast']:
+    elif data_type == 'europe-forecast':
+        years = ["2022", "2023"]
+
+    return years
+
+
+def reproject_data_type(data_type):
+    '''
+    Aligns all the years of a type of dataset to the 2022 grid,
+    concatenates them and reprojects the GHSL layer to match.
+    '''
+
+    years = get_years(data_type)
 
+    # Creates a dictionary with all the datasets
+    datasets = { }
+    for year in years:
+        datasets[year] = xr.open_zarr(f"../output/4.{data_type}-reduced-{year}.zarr", consolidated=True, decode_coords='all')
 
-        # Each type of dataset covers a different time range
-        if data_type == 'europe-reanalysis':
-            years = ["2018", "2019", "2020", "2021", "2022"]
+    # 2022 as the target year, all others should be reprojected according to it
+    target = datasets["2022"]
+    to_reproject = [ datasets[year] for year in years if year != "2022"]
 
-        elif data_type == 'europe-forecast':
-            years = ["2022", "2023"]
+    # The destination grid is read once and shared by every reprojection below
+    grid = get_grid(target)
 
-        # Creates a dictionary with all the datasets
-        datasets = { }
-        for year in years:
-            datasets[year] = xr.open_dataset(f"../output/4.{data_type}-reduced-{year}.netcdf", decode_coords='all')
+    # Reprojects
+    reprojected_datasets = reproject_and_assign_coords(target, to_reproject, grid)
 
-        # 2022 as the target year, all others should be reprojected according to it
-        target = datasets["2022"]
-        to_reproject = [ datasets[year] for year in years if year != "2022"]
+    # Concatenates and saves the reprojected datasets
+    reprojected_datasets.append(target)
+    reprojected_datasets = xr.concat(reprojected_datasets, dim='time')
+    save_zarr(reprojected_datasets, f"../output/5.{data_type}-reprojected.zarr", chunks={"time": 30, "y": 512, "x": 512})
 
-        # Reprojects
-        reprojected_datasets = reproject_and_assign_coords(target, to_reproject)
+    # Also reprojects the GHSL layer
+    ghsl = xr.open_dataset("../data/GHSL/whole-globe/ghsl.tif")
+    # Warps on all the cores, with a 512 MB working buffer (warp_mem_limit is in MB)
+    ghsl = ghsl.rio.reproject(**grid,
+                              resampling=Resampling.sum,
+                              num_threads=os.cpu_count(),
+                              warp_mem_limit=512)
+
+    # Assigns the coordinates from the target raster to the reprojected source raster to avoid rounding errors
+    ghsl = ghsl.assign_coords({
+        "x": reprojected_datasets.x,
+        "y": reprojected_datasets.y, 
+    })
+
+    save_zarr(ghsl, f"../output/5.ghsl-{data_type}-reprojected.zarr", chunks={"y": 512, "x": 512})
+
+
+def main():
+
+    data_types = [ ]
+
+    for data_type in ['europe-reanalysis', 'europe-forecast']:
 
-        # Concatenates and saves the reprojected datasets
-        reprojected_datasets.append(target)
-        reprojected_datasets = xr.concat(reprojected_datasets, dim='time')
-        reprojected_datasets.to_netcdf(f"../output/5.{data_type}-reprojected.netcdf")
+        # Skips the types of dataset that were reprojected after
+        # the last change to any of the years or to the GHSL layer
+        inputs = [f"../output/4.{data_type}-reduced-{year}.zarr" for year in get_years(data_type)]
+        inputs.append("../data/GHSL/whole-globe/ghsl.tif")
 
-        # Also reprojects the GHSL layer
-        ghsl = xr.open_dataset("../data/GHSL/whole-globe/ghsl.tif")
-        ghsl = ghsl.rio.reproject_match(reprojected_datasets, resampling=Resampling.sum)
+        if (is_up_to_date(f"../output/5.{data_type}-reprojected.zarr", inputs) and 
+            is_up_to_date(f"../output/5.ghsl-{data_type}-reprojected.zarr", inputs)):
+            print(f"{data_type} already reprojected. Skipping.")
+            continue
 
-        # Assigns the coordinates from the target raster to the reprojected source raster to avoid rounding errors
-        ghsl = ghsl.assign_coords({
-            "x": reprojected_datasets.x,
-            "y": reprojected_datasets.y, 
-        })
+        data_types.append(data_type)
 
-        ghsl.to_netcdf(f"../output/5.ghsl-{data_type}-reprojected.netcdf")
+    # The types of dataset run one after the other. Each warp already uses
+    # all the cores, and each type is held in memory while it's reprojected.
+    for data_type in data_types:
+        reproject_data_type(data_type)
 
 
 if __name__ == "__main__":